@@ -1 +1,3 @@
-from .main import run
+from .main import run, load_combined_model
+from .batch import run_batch
+from .xspec_executor import XspecExecutor
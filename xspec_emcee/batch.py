@@ -0,0 +1,185 @@
+"""
+Run many xspec-emcee jobs, sharing a set of systems.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import argparse
+import json
+import os.path
+import shlex
+import threading
+import time
+from collections import deque
+
+import h5py
+
+from .main import make_parser, mcmc_args, do_mcmc, expand_systems
+
+class BatchJob:
+    """A job from the manifest file."""
+
+    def __init__(self, line, nprocs):
+        parser = make_parser()
+        # outputs default to names based on the XCM file
+        parser.set_defaults(output_hdf5=None)
+        args = parser.parse_args(shlex.split(line))
+
+        if args.calibrate or args.autotune:
+            raise RuntimeError(
+                'Cannot use --calibrate or --autotune in batch mode')
+
+        base = os.path.splitext(args.xcms[0])[0]
+        if args.output_hdf5 is None:
+            args.output_hdf5 = base + '.hdf5'
+
+        self.line = line
+        self.nprocs = nprocs
+        self.kwargs = mcmc_args(args, basechain=base+'.chain')
+        self.outhdf5 = self.kwargs['outhdf5']
+
+    def has_chain(self):
+        """Is there a partial chain in the output file to continue?"""
+        if not os.path.exists(self.outhdf5):
+            return False
+        try:
+            with h5py.File(self.outhdf5, "r") as f:
+                return f["chain"].attrs.get("count", 0) > 0
+        except (IOError, KeyError):
+            return False
+
+    def run(self, systems, stopevent):
+        """Run the job on the systems given.
+
+        Returns True if the chain is complete."""
+        kwargs = dict(self.kwargs)
+        kwargs['systems'] = systems
+        kwargs['stopevent'] = stopevent
+        # identify output of this job among the others running
+        kwargs['prefix'] = '[%s] ' % os.path.splitext(
+            os.path.basename(self.outhdf5))[0]
+        if self.has_chain():
+            print('Continuing', self.outhdf5)
+            kwargs['continuerun'] = True
+        return do_mcmc(**kwargs)
+
+def read_manifest(filename, nprocs):
+    """Read jobs from manifest file. Each line has the command line
+    arguments for a job. Empty lines and those starting with # are
+    ignored."""
+
+    jobs = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and line[:1] != '#':
+                jobs.append(BatchJob(line, nprocs))
+
+    outputs = [job.outhdf5 for job in jobs]
+    if len(set(outputs)) != len(outputs):
+        raise RuntimeError('Jobs in manifest must have different outputs')
+    return jobs
+
+class BatchState:
+    """Record of which jobs have finished, so that a batch can be
+    resumed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.status = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.status = json.load(f)
+
+    def is_done(self, job):
+        return self.status.get(job.outhdf5) == 'done'
+
+    def set_status(self, job, status):
+        self.status[job.outhdf5] = status
+        with open(self.filename, 'w') as f:
+            json.dump(self.status, f, indent=1, sort_keys=True)
+
+def run_jobs(jobs, systems, state, poll=1.):
+    """Run jobs on the systems given, running as many at once as
+    there are free systems for them."""
+
+    free = list(systems)
+    for job in jobs:
+        if job.nprocs > len(free):
+            raise RuntimeError(
+                'Job needs more processes than systems: %s' % job.line)
+
+    pending = deque(job for job in jobs if not state.is_done(job))
+    print('%i of %i job(s) to run' % (len(pending), len(jobs)))
+
+    stopevent = threading.Event()
+    running = {}
+    results = {}
+
+    def runjob(job, jobsystems):
+        try:
+            results[job] = 'done' if job.run(jobsystems, stopevent) else 'stopped'
+        except Exception as e:
+            print('Job %s failed: %s' % (job.line, e))
+            results[job] = 'failed'
+
+    try:
+        while pending or running:
+            # start jobs while there are enough free systems
+            while pending and pending[0].nprocs <= len(free):
+                job = pending.popleft()
+                jobsystems = free[:job.nprocs]
+                del free[:job.nprocs]
+                print('Starting job %s on %s' % (job.line, ' '.join(jobsystems)))
+                thread = threading.Thread(target=runjob, args=(job, jobsystems))
+                thread.daemon = True
+                thread.start()
+                running[thread] = (job, jobsystems)
+
+            time.sleep(poll)
+
+            # return systems of finished jobs
+            for thread in list(running):
+                if not thread.is_alive():
+                    job, jobsystems = running.pop(thread)
+                    free += jobsystems
+                    state.set_status(job, results[job])
+                    print('Job %s: %s' % (job.line, results[job]))
+
+    except KeyboardInterrupt:
+        print('Ctrl+C pressed - stopping jobs')
+        stopevent.set()
+        for thread, (job, jobsystems) in running.items():
+            thread.join()
+            state.set_status(job, results.get(job, 'stopped'))
+
+def run_batch():
+    """Main program for batch mode."""
+
+    p = argparse.ArgumentParser(
+        description="Run a batch of Xspec MCMC with EMCEE jobs, sharing "
+        "the systems given. Jeremy Sanders 2012-2017.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    p.add_argument("manifest", metavar="MANIFEST",
+                   help="File with xspec-emcee arguments for each job, "
+                   "one per line")
+    p.add_argument("--systems", default="localhost", metavar="LIST",
+                   help="Space-separated list of computers to run on")
+    p.add_argument("--procs-per-job", metavar="N", type=int, default=1,
+                   help="Number of systems to use for each job")
+    p.add_argument("--state", metavar="FILE",
+                   help="File recording finished jobs "
+                   "(MANIFEST.state.json if not set)")
+
+    args = p.parse_args()
+
+    statefile = args.state
+    if statefile is None:
+        statefile = args.manifest + '.state.json'
+
+    jobs = read_manifest(args.manifest, args.procs_per_job)
+    run_jobs(
+        jobs, expand_systems(args.systems.split()), BatchState(statefile))
+
+    print("Done")
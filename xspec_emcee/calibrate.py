@@ -0,0 +1,226 @@
+from __future__ import print_function, division, absolute_import
+
+import json
+import os.path
+import select
+import time
+
+from .xspec_executor import ProcState, HostHealth
+
+def _concurrent_round(procs, cmds):
+    """Send a command to each process and wait for all the results.
+
+    Returns the time taken."""
+    start = time.time()
+    for proc, cmd in zip(procs, cmds):
+        proc.send_cmd(cmd)
+    waiting = {proc.fileno(): proc for proc in procs}
+    while waiting:
+        for fileno in select.select(list(waiting), [], [])[0]:
+            if waiting[fileno].read_buffer() is not None:
+                del waiting[fileno]
+    return time.time() - start
+
+def _slot_round(slots, cmds):
+    """Send each command to every process of its slot (one process
+    from each split group), waiting for all the results.
+
+    Returns the time taken."""
+    procs = []
+    allcmds = []
+    for slot, cmd in zip(slots, cmds):
+        procs += slot
+        allcmds += [cmd]*len(slot)
+    return _concurrent_round(procs, allcmds)
+
+def measure_performance(combmodel, p0, nrepeat=3, chunktest=4):
+    """Measure evaluation performance using real evaluations of the
+    parameter sets p0 (e.g. the initial walker positions).
+
+    An evaluation is done by a slot, made up of one process from each
+    group the spectra are split between (a single process if they are
+    not split). For each host, this measures the rate of evaluations
+    with different numbers of its slots running at once, and the time
+    of an evaluation and the overhead of each round trip to one of
+    its slots, by comparing single evaluations with chunks of
+    chunktest evaluations. The processes of the first XCM file are
+    used.
+
+    Returns a dict of the measurements.
+    """
+
+    xmodel = combmodel.xspecmodels[0]
+    groups = xmodel.procgroups
+    state = ProcState(combmodel, xmodel, groups[0], HostHealth())
+
+    # cycle through parameter sets
+    counter = [0]
+    def nextcmd(n=1):
+        valslist = []
+        for i in range(n):
+            valslist.append(p0[counter[0] % len(p0)])
+            counter[0] += 1
+        return state.job_cmd(valslist)
+
+    # first evaluation may be slow
+    _concurrent_round(xmodel.procs, [nextcmd() for p in xmodel.procs])
+
+    hosts = []
+    for proc in xmodel.procs:
+        if proc.system not in hosts:
+            hosts.append(proc.system)
+
+    hostinfo = {}
+    for host in list(hosts):
+        # combine processes of host in each group into slots
+        slots = list(zip(*[
+                    [p for p in group if p.system == host]
+                    for group in groups]))
+        if not slots:
+            print(' %s: too few processes to evaluate all the spectra' %
+                  host)
+            hosts.remove(host)
+            continue
+
+        counts = [1]
+        while counts[-1]*2 < len(slots):
+            counts.append(counts[-1]*2)
+        if counts[-1] != len(slots):
+            counts.append(len(slots))
+
+        rates = {}
+        for num in counts:
+            elapsed = 0.
+            for r in range(nrepeat):
+                elapsed += _slot_round(
+                    slots[:num], [nextcmd() for i in range(num)])
+            rates[num] = num*nrepeat / elapsed
+            print(' %s: %i process(es), %.3g evaluations/s' % (
+                    host, num*len(groups), rates[num]))
+
+        # time single evaluations and chunks on one slot
+        slot = slots[0]
+        single = min(
+            _slot_round([slot], [nextcmd()]) for r in range(nrepeat))
+        chunk = min(
+            _slot_round([slot], [nextcmd(chunktest)])
+            for r in range(nrepeat))
+        evaltime = max((chunk-single) / (chunktest-1), 1e-6)
+        overhead = max(single-evaltime, 0.)
+        print(' %s: evaluation time %.3gs, round trip overhead %.3gs' % (
+                host, evaltime, overhead))
+
+        hostinfo[host] = {
+            'counts': counts,
+            'rates': [rates[n] for n in counts],
+            'evaltime': evaltime,
+            'overhead': overhead,
+        }
+
+    if not hosts:
+        raise RuntimeError('No host has enough processes to calibrate')
+
+    return {
+        'hosts': hosts,
+        'hostinfo': hostinfo,
+        'ndims': len(combmodel.thawedparams),
+    }
+
+def recommend_tuning(measured, nwalkers, nsplit=1, tolerance=0.05,
+                     maxchunk=16):
+    """Recommend process layout, chunk size and number of walkers
+    from performance measurements.
+
+    For each host, the smallest number of slots (of nsplit processes)
+    within tolerance of the best evaluation rate is used. The chunk
+    size is the smallest which makes the round trip overhead less
+    than tolerance of the evaluation time on every host, provided all
+    slots are kept busy. The number of walkers is at least nwalkers
+    and a multiple of twice the number of evaluations which can be
+    done at once (emcee evaluates half of the walkers at a time).
+    """
+
+    systems = []
+    hostrates = {}
+    for host in measured['hosts']:
+        info = measured['hostinfo'][host]
+        best = max(info['rates'])
+        for num, hrate in zip(info['counts'], info['rates']):
+            if hrate >= best*(1-tolerance):
+                break
+        systems += [host]*(num*nsplit)
+        hostrates[host] = hrate
+    # number of evaluations which can be done at once
+    nslots = len(systems) // nsplit
+
+    # chunk size is set by the host with the largest relative overhead
+    worst = max(
+        measured['hostinfo'].values(),
+        key=lambda info: info['overhead'] / info['evaltime'])
+    evaltime = worst['evaltime']
+    overhead = worst['overhead']
+    chunksize = 1
+    while chunksize < maxchunk and overhead > tolerance*chunksize*evaltime:
+        chunksize += 1
+    chunksize = max(1, min(chunksize, (nwalkers//2) // nslots))
+
+    slots = 2*nslots*chunksize
+    nmin = max(nwalkers, 2*measured['ndims']+2)
+    nwalkers = -(-nmin // slots) * slots
+
+    # expected rate allowing for reduced overhead with chunks
+    rate = 0.
+    for host in measured['hosts']:
+        info = measured['hostinfo'][host]
+        rate += hostrates[host] * (
+            (info['overhead']+info['evaltime']) /
+            (info['overhead']/chunksize+info['evaltime']))
+
+    return {
+        'systems': systems,
+        'chunksize': chunksize,
+        'nwalkers': nwalkers,
+        'rate': rate,
+    }
+
+def print_tuning(tune):
+    """Show recommended settings."""
+    layout = []
+    for host in sorted(set(tune['systems'])):
+        layout.append('%s*%i' % (host, tune['systems'].count(host)))
+    print('Recommended settings (%.3g evaluations/s):' % tune['rate'])
+    print('  --systems="%s" --chunk-size=%i --nwalkers=%i' % (
+            ' '.join(layout), tune['chunksize'], tune['nwalkers']))
+
+def tuning_filename(xcms):
+    """Name of file to cache calibration for XCM files."""
+    return os.path.abspath(xcms[0]) + '.tune.json'
+
+def tuning_key(xcms, systems, nsplit):
+    """Values which must match for a cached calibration to be used."""
+    return {
+        'xcms': [os.path.abspath(x) for x in xcms],
+        'mtimes': [os.path.getmtime(x) for x in xcms],
+        'systems': list(systems),
+        'nsplit': nsplit,
+    }
+
+def load_tuning(xcms, key):
+    """Load cached measurements, returning None if missing or out of
+    date."""
+    filename = tuning_filename(xcms)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        cache = json.load(f)
+    if cache.get('key') != key:
+        return None
+    print("Using cached calibration from", filename)
+    return cache['measured']
+
+def save_tuning(xcms, key, measured):
+    """Cache measurements for XCM files."""
+    filename = tuning_filename(xcms)
+    print("Writing calibration to", filename)
+    with open(filename, 'w') as f:
+        json.dump({'key': key, 'measured': measured}, f, indent=1)
@@ -40,7 +40,7 @@ proc emcee_pars { } {
 # get statistic
 proc emcee_statistic { } {
     global HSTART HEND
-    puts "$HSTART[tcloutr stat]$END"
+    puts "$HSTART[tcloutr stat]$HEND"
 }
 
 proc emcee_batch { pars } {
@@ -54,7 +54,7 @@ proc emcee_batch { pars } {
         lappend stats [tcloutr stat]
     }
 
-    puts "$HSTART$stats$END"
+    puts "$HSTART$stats$HEND"
 }
 
 # loop taking parameters and returning results
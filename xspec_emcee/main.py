@@ -4,7 +4,8 @@
 Use EMCEE to do MCMC in Xspec.
 Jeremy Sanders 2012-2017
 
-Requires Python 2.7+, numpy, h5py and emcee
+Requires Python 2.7+, numpy, h5py and emcee (and the futures
+backport of concurrent.futures for Python 2)
 """
 
 from __future__ import print_function, division, absolute_import
@@ -20,6 +21,10 @@ import emcee
 
 from .xspec_model import XspecModel
 from .xspec_pool import XspecPool, CombinedModel
+from .xspec_executor import XspecExecutor
+from . import calibrate
+from .transform import ParamTransform
+from .ptsampler import PTSampler
 
 def gen_initial_parameters(parameters, nwalkers):
     """Construct list of initial parameter values for each walker."""
@@ -47,6 +52,91 @@ def gen_initial_parameters(parameters, nwalkers):
         p0.append(N.array(pwalker))
     return N.array(p0)
 
+def param_id(par):
+    """Identifier for parameter stored in HDF5 file."""
+    return '%i:%s:%s:%s:%i' % (
+        par.xspecindex, par.model, par.cmpt, par.name, par.index)
+
+def map_chain_params(oldids, parameters):
+    """Map parameters to columns of a chain with parameters oldids.
+
+    Parameters are matched by xcm index, model, component, name and
+    parameter index. If this fails, they are matched ignoring the
+    parameter index, if the component and name is unique in both
+    sets (i.e. components have been added or removed from the
+    model). Returns a list with column index or None if not found.
+    """
+
+    def shortid(pid):
+        return tuple(pid.split(':')[:4])
+
+    oldshort = [shortid(x) for x in oldids]
+    newshort = [shortid(param_id(p)) for p in parameters]
+
+    out = []
+    for par, short in zip(parameters, newshort):
+        pid = param_id(par)
+        if pid in oldids:
+            out.append(oldids.index(pid))
+        elif oldshort.count(short) == 1 and newshort.count(short) == 1:
+            out.append(oldshort.index(short))
+        else:
+            out.append(None)
+    return out
+
+def initial_parameters_from_chain(filename, parameters, nwalkers, fraction):
+    """Construct initial parameters for each walker by drawing from
+    the last fraction of the iterations of an existing HDF5 chain.
+
+    Parameters not found in the chain are generated using
+    gen_initial_parameters."""
+
+    with h5py.File(filename, "r") as f:
+        chain = f["chain"]
+        count = chain.attrs["count"]
+        oldids = chain.attrs.get("params")
+        first = min(int(count*(1-fraction)), count-1)
+        samples = N.array(chain[:, first:count, :])
+    samples = samples.reshape(-1, samples.shape[-1])
+
+    if oldids is None:
+        # older files do not record the parameters
+        if samples.shape[1] != len(parameters):
+            raise RuntimeError(
+                'Chain does not have same number of parameters and '
+                'does not record parameter names')
+        cols = list(range(len(parameters)))
+    else:
+        if not isinstance(oldids, str):
+            oldids = oldids.decode('utf8')
+        cols = map_chain_params(oldids.split(), parameters)
+
+    for par, col in zip(parameters, cols):
+        if col is None:
+            print(' Parameter %s not in chain, generating' % param_id(par))
+
+    # draw random subset of samples, generating unmapped parameters
+    p0 = gen_initial_parameters(parameters, nwalkers)
+    order = N.random.permutation(len(samples))
+    walker = 0
+    for si in order:
+        if walker == nwalkers:
+            break
+        pwalker = p0[walker].copy()
+        for pi, col in enumerate(cols):
+            if col is not None:
+                pwalker[pi] = samples[si, col]
+        # priors may have changed since the chain was made
+        if all(N.isfinite(par.prior(v))
+               for par, v in zip(parameters, pwalker)):
+            p0[walker] = pwalker
+            walker += 1
+    if walker < nwalkers:
+        raise RuntimeError(
+            'Not enough samples in chain with finite prior for walkers')
+
+    return p0
+
 def expand_systems(systems):
     """Allow system*N syntax in systems."""
     out = []
@@ -58,20 +148,20 @@ def expand_systems(systems):
             out.append(s)
     return out
 
-def do_mcmc(xcms,
-            nwalkers=100, nburn=100, niters=1000,
-            systems=['localhost'],
-            outchain=['out.chain'],
-            outhdf5='out.hdf5',
-            debug=False,
-            continuerun=False,
-            nofit=False,
-            autosave=True,
-            nochdir=False,
-            initialparameters=None,
-            lognorm=False,
-            link=[]):
-    """Do the actual MCMC process."""
+def load_combined_model(xcms,
+                        systems=['localhost'],
+                        debug=False,
+                        nochdir=False,
+                        nofit=False,
+                        lognorm=False,
+                        link=[],
+                        nsplit=1,
+                        splitby='spectrum'):
+    """Start xspec processes for each XCM file and return the
+    CombinedModel.
+
+    The processes can be used by other samplers with an XspecExecutor.
+    """
 
     print("Loading XCM file(s)")
     xmodels = []
@@ -84,6 +174,8 @@ def do_mcmc(xcms,
             nochdir=nochdir,
             nofit=nofit,
             xspecindex=i+1,
+            nsplit=nsplit,
+            splitby=splitby,
         ) )
     combmodel = CombinedModel(xmodels)
 
@@ -96,87 +188,285 @@ def do_mcmc(xcms,
         for expr in link:
             combmodel.link_parameters(expr)
 
-    print("Total number of free parameters: %i\n" % len(combmodel.thawedparams))
-
-    if not initialparameters:
-        print("Generating initial parameters")
-        p0 = gen_initial_parameters(combmodel.thawedparams, nwalkers)
-    else:
-        print("Loading initial parameters from", initialparameters)
-        p0 = N.loadtxt(initialparameters)
-
-    ndims = p0.shape[1]
-    pool = XspecPool(combmodel)
-
-    # sample the mcmc
-    sampler = emcee.EnsembleSampler(nwalkers, ndims, None, pool=pool)
-
-    print("Starting MCMC")
-    if not continuerun and nburn > 0:
-        # burn in
-        print("Burn in period started")
-        pos, prob, state = sampler.run_mcmc(p0, nburn)
-        sampler.reset()
-        print("Burn in period finished")
-    else:
-        # no burn in
-        state = None
-        pos = p0
-
-    if not continuerun:
-        # create new datasets, extensible along number of iterations
-        hdf5file = h5py.File(outhdf5, "w")
-        chain = hdf5file.create_dataset(
-            "chain",
-            (nwalkers, niters, ndims),
-            maxshape=(nwalkers, None, ndims))
-        lnprob = hdf5file.create_dataset(
-            "lnprob",
-            (nwalkers, niters),
-            maxshape=(nwalkers, None))
-        start = 0
-
-    else:
-        print("Continuing from existing chain in", outhdf5)
-
-        hdf5file = h5py.File(outhdf5, "r+")
-        chain = hdf5file["chain"]
-        lnprob = hdf5file["lnprob"]
-
-        start = chain.attrs["count"]
-        pos = N.array(chain[:, start-1, :])
-        print("Restarting at iteration", start)
-
-        chain.resize((nwalkers, niters, ndims))
-        lnprob.resize((nwalkers, niters))
+    return combmodel
 
-    # iterator interface allows us to trap ctrl+c and know where we are
-    lastsave = time.time()
-    index = start
+def do_mcmc(xcms,
+            nwalkers=100, nburn=100, niters=1000,
+            systems=['localhost'],
+            outchain=['out.chain'],
+            outhdf5='out.hdf5',
+            debug=False,
+            continuerun=False,
+            nofit=False,
+            autosave=True,
+            nochdir=False,
+            initialparameters=None,
+            initialchain=None,
+            initialfraction=0.25,
+            lognorm=False,
+            link=[],
+            transforms=[],
+            whiten=False,
+            nsplit=1,
+            splitby='spectrum',
+            jobtimeout=None,
+            starttimeout=600.,
+            maxfailures=3,
+            chunksize=1,
+            calibrateonly=False,
+            autotune=False,
+            stopevent=None,
+            ntemps=1,
+            tmax=N.inf,
+            prefix=''):
+    """Do the actual MCMC process.
+
+    transforms is a list of PAR=TYPE expressions to sample parameters
+    PAR in the space TYPE (linear, log or logit). If whiten is set the
+    parameters are also affinely whitened using the walker ensemble.
+
+    If initialchain is set, the walkers are started from random
+    samples from the last initialfraction of the iterations of that
+    HDF5 chain.
+
+    If nsplit > 1, the spectra in each XCM are split between nsplit
+    groups of processes (by spectrum or data group, given by splitby),
+    so that a single evaluation is computed in parallel.
+
+    Xspec processes which exit or take longer than jobtimeout seconds
+    for a job (or starttimeout seconds to restart) are restarted.
+    Hosts are not used for a period if they fail maxfailures times in
+    a row. Up to chunksize evaluations are sent to a process at once.
+
+    If calibrateonly is set, the performance of the processes is
+    measured and recommended settings are shown. If autotune is set,
+    the recommended process layout, chunk size and number of walkers
+    are used, using a cached calibration for the XCM if possible.
+
+    If ntemps > 1, parallel tempering is used with ntemps
+    temperatures (the hottest at tmax). Only the cold chain is stored,
+    with the evidence and final state of all temperatures.
+
+    If stopevent (a threading.Event) is set, sampling is ended as if
+    Ctrl+C were pressed.
+
+    prefix is added to the start of progress and process failure
+    messages, to identify the run when several are going at once.
+
+    Returns True if the chain was completed.
+    """
+
+    def loadmodel():
+        return load_combined_model(
+            xcms, systems=systems, debug=debug, nochdir=nochdir, nofit=nofit,
+            lognorm=lognorm, link=link, nsplit=nsplit, splitby=splitby)
+
+    # make sure the xspec processes are stopped however we exit
+    combmodel = None
+    executor = None
     try:
-        for p, l, s in sampler.sample(
-                pos,
-                rstate0=state,
-                store=False,
-                iterations=niters-start):
-
-            chain[:, index, :] = p
-            lnprob[:, index] = l
-            index += 1
-
-            if autosave and time.time() - lastsave > 60*10:
-                chain.attrs["count"] = index
-                hdf5file.flush()
+        if calibrateonly or autotune:
+            systems = expand_systems(systems)
+            key = calibrate.tuning_key(xcms, systems, nsplit)
+            measured = None
+            if not calibrateonly:
+                measured = calibrate.load_tuning(xcms, key)
+            if measured is None:
+                combmodel = loadmodel()
+                print("Calibrating using evaluations from initial parameters")
+                measured = calibrate.measure_performance(
+                    combmodel, gen_initial_parameters(
+                        combmodel.thawedparams, max(nwalkers, 16)))
+                calibrate.save_tuning(xcms, key, measured)
+
+            tune = calibrate.recommend_tuning(
+                measured, nwalkers, nsplit=nsplit)
+            calibrate.print_tuning(tune)
+            if calibrateonly:
+                return False
+
+            chunksize = tune['chunksize']
+            if not continuerun and not initialparameters:
+                nwalkers = tune['nwalkers']
+            if (combmodel is not None and
+                    sorted(tune['systems']) != sorted(systems)):
+                # restart with new layout
+                combmodel.finish()
+                combmodel = None
+            systems = tune['systems']
+
+        if combmodel is None:
+            combmodel = loadmodel()
+
+        transform = ParamTransform(combmodel.thawedparams)
+        if transforms:
+            print("Setting parameter transforms")
+            for expr in transforms:
+                spec, name = expr.rsplit('=', 1)
+                for idx in combmodel.select_params(spec):
+                    transform.set_transform(idx, name.strip())
+
+        print("Total number of free parameters: %i\n" % len(combmodel.thawedparams))
+
+        if initialchain:
+            print("Drawing initial parameters from chain", initialchain)
+            p0 = initial_parameters_from_chain(
+                initialchain, combmodel.thawedparams, nwalkers,
+                initialfraction)
+        elif not initialparameters:
+            print("Generating initial parameters")
+            p0 = gen_initial_parameters(combmodel.thawedparams, nwalkers)
+        else:
+            print("Loading initial parameters from", initialparameters)
+            p0 = N.loadtxt(initialparameters)
+
+        ndims = p0.shape[1]
+        executor = XspecExecutor(
+            combmodel, jobtimeout=jobtimeout, starttimeout=starttimeout,
+            maxfailures=maxfailures,
+            chunksize=chunksize, prefix=prefix)
+        pool = XspecPool(
+            combmodel, executor, transform=transform, prefix=prefix)
+
+        # walker positions are in the sampling space of the transform
+        if whiten and not continuerun and nburn <= 0:
+            print("Whitening parameters using initial ensemble")
+            p0 = transform.whiten(p0)
+        else:
+            p0 = transform.from_physical_many(p0)
+
+        # sample the mcmc
+        if ntemps > 1:
+            print("Using parallel tempering with %i temperatures" % ntemps)
+            sampler = PTSampler(
+                executor, combmodel, transform, nwalkers, ndims, ntemps,
+                tmax=tmax, prefix=prefix)
+        else:
+            sampler = emcee.EnsembleSampler(nwalkers, ndims, None, pool=pool)
+
+        def savecount(index):
+            chain.attrs["count"] = index
+            if ntemps > 1:
+                sampler.save_state(hdf5file)
+
+        print("Starting MCMC")
+        if not continuerun and nburn > 0:
+            # burn in
+            print("Burn in period started")
+            for pos, prob, state in sampler.sample(
+                    p0, iterations=nburn, store=False):
+                if stopevent is not None and stopevent.is_set():
+                    print("Stop requested during burn in - ending")
+                    return False
+            sampler.reset()
+            print("Burn in period finished")
+            if whiten:
+                print("Whitening parameters using burn in ensemble")
+                if ntemps > 1:
+                    allpos = transform.to_physical_many(sampler.pos)
+                pos = transform.whiten(transform.to_physical_many(pos))
+                if ntemps > 1:
+                    sampler.set_positions(
+                        transform.from_physical_many(allpos),
+                        logl=sampler.logl)
+        else:
+            # no burn in
+            sampler.reset()
+            state = None
+            pos = p0
+
+        if not continuerun:
+            # create new datasets, extensible along number of iterations
+            hdf5file = h5py.File(outhdf5, "w")
+            chain = hdf5file.create_dataset(
+                "chain",
+                (nwalkers, niters, ndims),
+                maxshape=(nwalkers, None, ndims))
+            lnprob = hdf5file.create_dataset(
+                "lnprob",
+                (nwalkers, niters),
+                maxshape=(nwalkers, None))
+            chain.attrs["transforms"] = ' '.join(transform.describe())
+            chain.attrs["params"] = ' '.join(
+                param_id(par) for par in combmodel.thawedparams)
+            chain.attrs["ntemps"] = ntemps
+            start = 0
 
-    except KeyboardInterrupt:
-        chain.attrs["count"] = index
-        print("Ctrl+C pressed - ending")
+        else:
+            print("Continuing from existing chain in", outhdf5)
 
-    else:
-        chain.attrs["count"] = index
-        write_xspec_chains(outchain, chain, lnprob, combmodel)
+            hdf5file = h5py.File(outhdf5, "r+")
+            chain = hdf5file["chain"]
+            lnprob = hdf5file["lnprob"]
 
-    hdf5file.close()
+            filetemps = chain.attrs.get("ntemps", 1)
+            if filetemps != ntemps:
+                hdf5file.close()
+                raise RuntimeError(
+                    "Cannot continue chain with %i temperature(s) using "
+                    "--ntemps=%i" % (filetemps, ntemps))
+
+            start = chain.attrs["count"]
+            pos = N.array(chain[:, start-1, :])
+            print("Restarting at iteration", start)
+            if whiten:
+                pos = transform.whiten(pos)
+            else:
+                pos = transform.from_physical_many(pos)
+            if ntemps > 1:
+                # restore all temperatures, without adapting the ladder
+                sampler.reset()
+                sampler.load_state(hdf5file)
+
+            chain.resize((nwalkers, niters, ndims))
+            lnprob.resize((nwalkers, niters))
+
+        # iterator interface allows us to trap ctrl+c and know where we are
+        lastsave = time.time()
+        index = start
+        completed = False
+        try:
+            for p, l, s in sampler.sample(
+                    pos,
+                    rstate0=state,
+                    store=False,
+                    iterations=niters-start):
+
+                # chain is always stored as physical parameters, with
+                # the log posterior in physical space (no Jacobian)
+                chain[:, index, :] = transform.to_physical_many(p)
+                lnprob[:, index] = l - N.array(
+                    [transform.log_jacobian(u) for u in p])
+                index += 1
+
+                if autosave and time.time() - lastsave > 60*10:
+                    savecount(index)
+                    hdf5file.flush()
+                    lastsave = time.time()
+
+                if stopevent is not None and stopevent.is_set():
+                    print("Stop requested - ending")
+                    break
+            else:
+                completed = True
+
+        except KeyboardInterrupt:
+            print("Ctrl+C pressed - ending")
+
+        savecount(index)
+        if ntemps > 1:
+            print("Log evidence: %g +- %g" % sampler.evidence())
+        if completed:
+            write_xspec_chains(outchain, chain, lnprob, combmodel)
+
+        hdf5file.close()
+        return completed
+    finally:
+        # stop xspec processes
+        if executor is not None:
+            executor.shutdown()
+        if combmodel is not None:
+            combmodel.finish()
 
 def write_xspec_chains(filenames, chain, lnprob, combmodel):
     """Write an xspec text chain file for each xcm input file."""
@@ -223,8 +513,8 @@ def write_xspec_chains(filenames, chain, lnprob, combmodel):
         with open(chainfilename, 'w') as chainf:
             innerwrite(chainf, xmodel)
 
-def run():
-    """Main program."""
+def make_parser():
+    """Make the command line parser."""
 
     p = argparse.ArgumentParser(
         description="Xspec MCMC with EMCEE. Jeremy Sanders 2012-2017.",
@@ -255,23 +545,67 @@ def run():
                    help="Do not chdir to XCM file directory before execution")
     p.add_argument("--initial-parameters", metavar="FILE",
                    help="Provide initial parameters")
+    p.add_argument("--initial-chain", metavar="FILE",
+                   help="Draw initial parameters from existing HDF5 chain")
+    p.add_argument("--initial-fraction", metavar="F", type=float,
+                   default=0.25,
+                   help="Fraction of last iterations in initial chain "
+                   "to draw from")
     p.add_argument("--log-norm", action="store_true", default=False,
                    help="Use priors equivalent to using log norms")
-    p.add_argument('--chunk-size', metavar='N', type=int, default=4,
-                   help='Currently ignored')
+    p.add_argument('--chunk-size', metavar='N', type=int, default=1,
+                   help='Maximum evaluations to send to a process at once')
+    p.add_argument("--calibrate", action="store_true", default=False,
+                   help="Measure performance and show recommended "
+                   "--systems, --chunk-size and --nwalkers, then exit")
+    p.add_argument("--autotune", action="store_true", default=False,
+                   help="Use recommended --systems, --chunk-size and "
+                   "--nwalkers (calibrating if not cached for XCM)")
     p.add_argument("--link", metavar="EXPR", action="append",
                    help="Link two parameters in model")
-
-    args = p.parse_args()
+    p.add_argument("--transform", metavar="PAR=TYPE", action="append",
+                   help="Sample parameter(s) in space TYPE (linear, log "
+                   "or logit), where PAR is [xcmindex:][[modelname]:]index "
+                   "or a parameter name (e.g. norm=log)")
+    p.add_argument("--split", metavar="N", type=int, default=1,
+                   help="Split the spectra of each XCM between N groups "
+                   "of processes to parallelise each evaluation")
+    p.add_argument("--split-by", default="spectrum",
+                   choices=("spectrum", "group"),
+                   help="Split spectra individually or by data group")
+    p.add_argument("--job-timeout", metavar="SECS", type=float, default=0,
+                   help="Restart xspec processes taking longer than this "
+                   "for an evaluation (0 to disable)")
+    p.add_argument("--start-timeout", metavar="SECS", type=float,
+                   default=600,
+                   help="Restart again xspec processes taking longer than "
+                   "this to reload the XCM after a restart (0 to disable)")
+    p.add_argument("--max-failures", metavar="N", type=int, default=3,
+                   help="Stop using a host for a while after N failures "
+                   "in a row")
+    p.add_argument("--ntemps", metavar="N", type=int, default=1,
+                   help="Number of temperatures for parallel tempering "
+                   "(1 to disable)")
+    p.add_argument("--tmax", metavar="T", type=float, default=N.inf,
+                   help="Temperature of hottest chain for parallel "
+                   "tempering (inf samples the prior)")
+    p.add_argument("--whiten", action="store_true", default=False,
+                   help="Affinely whiten sampled parameters using walker "
+                   "ensemble after burn in")
+
+    return p
+
+def mcmc_args(args, basechain='emcee.chain'):
+    """Convert parsed command line arguments to arguments for do_mcmc."""
 
     # get list of output chain files
     # this is complex as it may not be the same as the number of xcm files
     outchain = args.output_chain
     if outchain is None:
         if len(args.xcms) == 1:
-            outchain = ['emcee.chain']
+            outchain = [basechain]
         else:
-            outchain = ['emcee.chain.%i' % (i+1) for i in range(len(args.xcms))]
+            outchain = [basechain+'.%i' % (i+1) for i in range(len(args.xcms))]
     else:
         if len(outchain) == 1 and '%' in outchain[0]:
             outchain = [outchain[0] % (i+1) for i in range(len(args.xcms))]
@@ -279,8 +613,8 @@ def run():
             if len(outchain) != len(args.xcms):
                 raise RuntimeError('Requires same number of output chains as input chains')
 
-    sampler = do_mcmc(
-        args.xcms,
+    return dict(
+        xcms = args.xcms,
         systems = args.systems.split(),
         nwalkers = args.nwalkers,
         nburn = args.nburn,
@@ -292,10 +626,30 @@ def run():
         debug = args.debug,
         nochdir = args.no_chdir,
         initialparameters = args.initial_parameters,
+        initialchain = args.initial_chain,
+        initialfraction = args.initial_fraction,
         lognorm = args.log_norm,
         link = args.link,
+        transforms = args.transform,
+        whiten = args.whiten,
+        nsplit = args.split,
+        splitby = args.split_by,
+        jobtimeout = args.job_timeout,
+        starttimeout = args.start_timeout,
+        maxfailures = args.max_failures,
+        chunksize = args.chunk_size,
+        calibrateonly = args.calibrate,
+        autotune = args.autotune,
+        ntemps = args.ntemps,
+        tmax = args.tmax,
     )
 
+def run():
+    """Main program."""
+
+    args = make_parser().parse_args()
+    do_mcmc(**mcmc_args(args))
+
     print("Done")
 
 if __name__ == '__main__':
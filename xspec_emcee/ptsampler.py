@@ -0,0 +1,293 @@
+from __future__ import print_function, division, absolute_import
+
+import numpy as N
+
+def default_betas(ntemps, ndims, tmax=N.inf):
+    """Inverse temperatures for ladder with ntemps temperatures.
+
+    If tmax is infinite, the hottest chain samples the prior and the
+    others are spaced geometrically with a step suitable for a
+    Gaussian posterior with ndims dimensions.
+    """
+    if N.isinf(tmax):
+        tstep = 1 + 2*N.sqrt(N.log(4) / ndims)
+        betas = tstep**-N.arange(ntemps-1, dtype=N.float64)
+        return N.concatenate((betas, [0.]))
+    return tmax**-(N.arange(ntemps, dtype=N.float64) / (ntemps-1))
+
+def thermodynamic_integration(betas, meanlogl):
+    """Estimate log evidence from the mean log likelihood at each
+    inverse temperature (betas in descending order).
+
+    Returns log evidence and error estimate, which is the difference
+    from using every other temperature.
+    """
+
+    def integrate(b, l):
+        if b[-1] != 0:
+            # hottest chain is taken to be close to the prior
+            b = N.concatenate((b, [0.]))
+            l = N.concatenate((l, [l[-1]]))
+        # trapezium rule (betas are descending)
+        return -N.sum(0.5*(l[1:]+l[:-1])*N.diff(b))
+
+    lnz = integrate(betas, meanlogl)
+    lnz2 = integrate(betas[::2], meanlogl[::2])
+    return lnz, abs(lnz-lnz2)
+
+class PTSampler:
+    """Parallel tempering ensemble sampler using an XspecExecutor.
+
+    Each temperature has an ensemble of nwalkers walkers, moved using
+    the affine invariant stretch move. The proposals for half of the
+    walkers of every temperature are evaluated together in one batch,
+    so that the xspec processes are kept busy. After each step,
+    walkers are swapped between neighbouring temperatures.
+
+    While adapting (until reset is called after burn in), the
+    temperature ladder is adjusted to equalise the swap acceptance
+    between neighbouring temperatures (Vousden et al. 2016). After
+    this, the mean log likelihood at each temperature is accumulated
+    to estimate the evidence.
+
+    Positions are in the sampling space of transform. Progress lines
+    are started with prefix. Random numbers are drawn from the
+    sampler's own RandomState (random), not the global one.
+    """
+
+    def __init__(self, executor, combmodel, transform, nwalkers, ndims,
+                 ntemps, tmax=N.inf, a=2., adaptlag=10000, adapttime=100,
+                 prefix=''):
+        self.executor = executor
+        self.prefix = prefix
+        self.combmodel = combmodel
+        self.transform = transform
+        self.nwalkers = nwalkers
+        self.ndims = ndims
+        self.ntemps = ntemps
+        self.a = a
+        self.adaptlag = adaptlag
+        self.adapttime = adapttime
+
+        self.random = N.random.RandomState()
+        self.betas = default_betas(ntemps, ndims, tmax=tmax)
+        self.adapting = True
+
+        # current state (ntemps, nwalkers, ...)
+        self.pos = None
+        self.logl = None
+        self.logp = None
+
+        # step number and swap acceptance totals
+        self.time = 0
+        self.nswapaccept = N.zeros(ntemps-1)
+        self.nswap = 0
+
+        # for evidence estimate
+        self.loglsum = N.zeros(ntemps)
+        self.nsteps = 0
+
+    def reset(self):
+        """End adaptation of the ladder (at end of burn in) and start
+        accumulating statistics."""
+        self.adapting = False
+        self.nswapaccept[:] = 0
+        self.nswap = 0
+        self.loglsum[:] = 0
+        self.nsteps = 0
+
+    def _evaluate(self, us):
+        """Get log likelihood and log prior (including Jacobian) for
+        array of positions with parameters on last axis."""
+
+        flat = us.reshape(-1, self.ndims)
+        tr = self.transform
+        phys = [tr.to_physical(u) for u in flat]
+        logp = N.array([
+                self.combmodel.prior(v) + tr.log_jacobian(u)
+                for u, v in zip(flat, phys)])
+        logl = N.full(len(flat), -N.inf)
+
+        # only evaluate parameters within prior
+        ok = N.nonzero(N.isfinite(logp))[0]
+        if len(ok) > 0:
+            logl[ok] = self.executor.map(
+                [phys[i] for i in ok], withprior=False)
+
+        return logl.reshape(us.shape[:-1]), logp.reshape(us.shape[:-1])
+
+    def set_positions(self, pos, logl=None):
+        """Set positions of all walkers (ntemps, nwalkers, ndims).
+
+        If logl is not given, the likelihoods are evaluated."""
+        self.pos = N.array(pos, dtype=N.float64)
+        if logl is None:
+            self.logl, self.logp = self._evaluate(self.pos)
+        else:
+            self.logl = N.array(logl)
+            self.logp = self._evaluate_prior(self.pos)
+
+    def _evaluate_prior(self, us):
+        flat = us.reshape(-1, self.ndims)
+        tr = self.transform
+        logp = [self.combmodel.prior(tr.to_physical(u)) + tr.log_jacobian(u)
+                for u in flat]
+        return N.array(logp).reshape(us.shape[:-1])
+
+    def _stretch(self, active, other):
+        """Move active walkers of each temperature using stretch
+        move with other walkers of the same temperature."""
+
+        T = self.ntemps
+        nact = len(active)
+        xact = self.pos[:, active]
+        partners = other[self.random.randint(len(other), size=(T, nact))]
+        xother = self.pos[N.arange(T)[:, None], partners]
+
+        z = ((self.a-1)*self.random.rand(T, nact) + 1)**2 / self.a
+        prop = xother + z[:, :, None]*(xact - xother)
+        newlogl, newlogp = self._evaluate(prop)
+
+        oldlogl = self.logl[:, active]
+        oldlogp = self.logp[:, active]
+        with N.errstate(invalid='ignore'):
+            lnratio = ((self.ndims-1)*N.log(z) +
+                       self.betas[:, None]*(newlogl-oldlogl) +
+                       (newlogp-oldlogp))
+            accept = (
+                N.isfinite(newlogl) & N.isfinite(newlogp) & (
+                    (N.log(self.random.rand(T, nact)) < lnratio) |
+                    ~N.isfinite(oldlogl+oldlogp)))
+
+        xact[accept] = prop[accept]
+        oldlogl[accept] = newlogl[accept]
+        oldlogp[accept] = newlogp[accept]
+        self.pos[:, active] = xact
+        self.logl[:, active] = oldlogl
+        self.logp[:, active] = oldlogp
+
+    def _swap(self):
+        """Swap walkers between neighbouring temperatures.
+
+        Returns fraction of swaps accepted for each pair."""
+
+        ratios = N.zeros(self.ntemps-1)
+        nw = self.nwalkers
+        for i in range(self.ntemps-1, 0, -1):
+            # pair walkers in temperature i with random walkers in i-1
+            perm = self.random.permutation(nw)
+            dbeta = self.betas[i-1] - self.betas[i]
+            with N.errstate(invalid='ignore'):
+                paccept = dbeta*(self.logl[i] - self.logl[i-1, perm])
+                sel = N.log(self.random.rand(nw)) < paccept
+            ratios[i-1] = sel.mean()
+
+            hot = N.nonzero(sel)[0]
+            cold = perm[sel]
+            for arr in self.pos, self.logl, self.logp:
+                tmp = arr[i, hot].copy()
+                arr[i, hot] = arr[i-1, cold]
+                arr[i-1, cold] = tmp
+
+        return ratios
+
+    def _adapt(self, ratios):
+        """Adjust temperatures to equalise swap acceptance ratios."""
+        decay = self.adaptlag / (self.time + self.adaptlag)
+        kappa = decay / self.adapttime
+        dss = kappa * (ratios[:-1] - ratios[1:])
+        # hottest and coldest temperatures are fixed
+        deltats = N.diff(1/self.betas[:-1]) * N.exp(dss)
+        self.betas[1:-1] = 1/(N.cumsum(deltats) + 1/self.betas[0])
+
+    def sample(self, p0, iterations=1, store=False, rstate0=None):
+        """Sample for the number of iterations given.
+
+        p0 is the positions of the walkers of all temperatures, or the
+        cold walkers only. For the cold walkers, if there is an
+        existing state, that is used instead, otherwise p0 is used
+        for every temperature.
+
+        Yields positions and log posterior for the cold walkers, and
+        the state of the random number generator after each step
+        (matching emcee.EnsembleSampler). If rstate0 is given, the
+        random number generator is set to this state first. store is
+        ignored.
+        """
+
+        if rstate0 is not None:
+            self.random.set_state(rstate0)
+
+        p0 = N.asarray(p0)
+        if p0.ndim == 3:
+            self.set_positions(p0)
+        elif self.pos is None:
+            self.set_positions(N.tile(p0, (self.ntemps, 1, 1)))
+
+        idxs = N.arange(self.nwalkers)
+        halves = idxs[:self.nwalkers//2], idxs[self.nwalkers//2:]
+
+        for it in range(iterations):
+            self._stretch(halves[0], halves[1])
+            self._stretch(halves[1], halves[0])
+
+            ratios = self._swap()
+            self.nswapaccept += ratios
+            self.nswap += 1
+            if self.adapting and self.ntemps > 2:
+                self._adapt(ratios)
+            else:
+                self.loglsum += N.mean(self.logl, axis=1)
+                self.nsteps += 1
+            self.time += 1
+
+            coldlike = self.logl[0] + self.logp[0]
+            likefilt = coldlike[N.isfinite(coldlike)]
+            if len(likefilt) > 0:
+                print('%s%5i   mean=<%9.1f> max=<%9.1f> std=<%9.1f> good=<%4i/%4i> swap=<%4.2f>' % (
+                        self.prefix,
+                        self.time,
+                        likefilt.mean(),
+                        likefilt.max(),
+                        likefilt.std(),
+                        len(likefilt), len(coldlike),
+                        N.mean(ratios),
+                        ))
+
+            yield self.pos[0].copy(), coldlike, self.random.get_state()
+
+    def evidence(self):
+        """Log evidence and error from thermodynamic integration."""
+        if self.nsteps == 0:
+            return N.nan, N.nan
+        return thermodynamic_integration(
+            self.betas, self.loglsum / self.nsteps)
+
+    def save_state(self, hdf5file):
+        """Save state of all temperatures (as physical values) and
+        evidence to HDF5 file, so that the run can be continued."""
+
+        if "pt" in hdf5file:
+            del hdf5file["pt"]
+        grp = hdf5file.create_group("pt")
+        grp.create_dataset("pos", data=self.transform.to_physical_many(self.pos))
+        grp.create_dataset("logl", data=self.logl)
+        grp.create_dataset("betas", data=self.betas)
+        grp.create_dataset("loglsum", data=self.loglsum)
+        grp.attrs["nsteps"] = self.nsteps
+        lnz, lnzerr = self.evidence()
+        grp.attrs["lnZ"] = lnz
+        grp.attrs["lnZerr"] = lnzerr
+        if self.nswap > 0:
+            grp.create_dataset(
+                "swapaccept", data=self.nswapaccept/self.nswap)
+
+    def load_state(self, hdf5file):
+        """Load state saved with save_state."""
+        grp = hdf5file["pt"]
+        self.betas = N.array(grp["betas"])
+        self.loglsum = N.array(grp["loglsum"])
+        self.nsteps = int(grp.attrs["nsteps"])
+        self.set_positions(
+            self.transform.from_physical_many(N.array(grp["pos"])),
+            logl=N.array(grp["logl"]))
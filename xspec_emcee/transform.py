@@ -0,0 +1,172 @@
+from __future__ import print_function, division, absolute_import
+
+import numpy as N
+
+class IdentityTransform:
+    """Sample parameter in its own (linear) space."""
+
+    name = 'linear'
+
+    def forward(self, v):
+        """Convert physical value to sampling space."""
+        return v
+
+    def inverse(self, u):
+        """Convert sampling value to physical space."""
+        return u
+
+    def log_jacobian(self, u):
+        """log |d(physical)/d(sampling)|."""
+        return 0.
+
+class LogTransform(IdentityTransform):
+    """Sample natural log of parameter (parameter must be positive)."""
+
+    name = 'log'
+
+    def __init__(self, par):
+        if par.maxval <= 0 or par.minval < 0:
+            raise RuntimeError(
+                'Log transform requires non-negative range for parameter '
+                '%i:%s:%s:%i' % (par.xspecindex, par.model, par.cmpt, par.index))
+
+    def forward(self, v):
+        return N.log(v)
+
+    def inverse(self, u):
+        return N.exp(u)
+
+    def log_jacobian(self, u):
+        return u
+
+class LogitTransform(IdentityTransform):
+    """Sample logit of parameter scaled to its hard bounds."""
+
+    name = 'logit'
+
+    def __init__(self, par):
+        self.minval = par.minval
+        self.width = par.maxval - par.minval
+        if not self.width > 0:
+            raise RuntimeError(
+                'Logit transform requires finite range for parameter '
+                '%i:%s:%s:%i' % (par.xspecindex, par.model, par.cmpt, par.index))
+
+    def forward(self, v):
+        f = (v - self.minval) / self.width
+        return N.log(f) - N.log1p(-f)
+
+    def inverse(self, u):
+        return self.minval + self.width / (1. + N.exp(-u))
+
+    def log_jacobian(self, u):
+        # log(width * s * (1-s)), where s is sigmoid(u), computed stably
+        return (N.log(self.width) -
+                N.logaddexp(0., -u) - N.logaddexp(0., u))
+
+# transform types selectable by the user
+transform_types = {
+    'linear': IdentityTransform,
+    'log': LogTransform,
+    'logit': LogitTransform,
+}
+
+class ParamTransform:
+    """Map between the parameter space seen by the sampler and the
+    physical parameters of the model.
+
+    Each thawed parameter has its own transform (linear, log or logit),
+    which can optionally be followed by an affine whitening of all the
+    parameters together.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.partrans = [IdentityTransform() for p in params]
+
+        # whitening: sampling = inv(chol) * (y - mean)
+        self.mean = None
+        self.chol = None
+        self.logdetchol = 0.
+
+    def set_transform(self, paridx, name):
+        """Use transform called name for parameter index given."""
+        if name not in transform_types:
+            raise RuntimeError('Unknown transform type %s' % repr(name))
+        par = self.params[paridx]
+        print(' Sampling %s value of parameter %i:%s:%s:%i' % (
+                name, par.xspecindex, par.model, par.cmpt, par.index))
+        if name == 'linear':
+            self.partrans[paridx] = IdentityTransform()
+        else:
+            self.partrans[paridx] = transform_types[name](par)
+
+    def describe(self):
+        """List of transform names for each parameter."""
+        return [t.name for t in self.partrans]
+
+    def _to_y(self, v):
+        return N.array([t.forward(x) for t, x in zip(self.partrans, v)])
+
+    def _from_y(self, y):
+        return N.array([t.inverse(x) for t, x in zip(self.partrans, y)])
+
+    def from_physical(self, v):
+        """Convert physical parameter vector to sampling space."""
+        y = self._to_y(v)
+        if self.chol is not None:
+            y = N.linalg.solve(self.chol, y - self.mean)
+        return y
+
+    def to_physical(self, u):
+        """Convert sampling space vector to physical parameters."""
+        u = N.asarray(u, dtype=N.float64)
+        if self.chol is not None:
+            u = self.mean + self.chol.dot(u)
+        return self._from_y(u)
+
+    def log_jacobian(self, u):
+        """Log of the Jacobian determinant of to_physical at u.
+
+        This is added to the log prior so that the posterior in
+        physical space is unchanged by the transform.
+        """
+        u = N.asarray(u, dtype=N.float64)
+        if self.chol is not None:
+            u = self.mean + self.chol.dot(u)
+        return self.logdetchol + sum(
+            t.log_jacobian(x) for t, x in zip(self.partrans, u))
+
+    def from_physical_many(self, vals):
+        """Convert an array of physical vectors (last axis parameters)."""
+        vals = N.asarray(vals)
+        out = [self.from_physical(v) for v in vals.reshape(-1, vals.shape[-1])]
+        return N.array(out).reshape(vals.shape)
+
+    def to_physical_many(self, us):
+        """Convert an array of sampling vectors (last axis parameters)."""
+        us = N.asarray(us)
+        out = [self.to_physical(u) for u in us.reshape(-1, us.shape[-1])]
+        return N.array(out).reshape(us.shape)
+
+    def whiten(self, physvals):
+        """Set the affine whitening from an ensemble of physical
+        parameter vectors (e.g. the walker positions after burn in).
+
+        Returns the ensemble in the new sampling space.
+        """
+        ys = N.array([self._to_y(v) for v in physvals])
+        mean = ys.mean(axis=0)
+        cov = N.atleast_2d(N.cov(ys, rowvar=False))
+        # regularise, so we don't fail for a degenerate ensemble
+        cov += N.diag(N.diag(cov)*1e-8 + 1e-300)
+        try:
+            chol = N.linalg.cholesky(cov)
+        except N.linalg.LinAlgError:
+            print(' Covariance not positive definite, whitening diagonally')
+            chol = N.diag(N.sqrt(N.diag(cov)))
+
+        self.mean = mean
+        self.chol = chol
+        self.logdetchol = N.sum(N.log(N.diag(chol)))
+        return N.array([N.linalg.solve(chol, y - mean) for y in ys])
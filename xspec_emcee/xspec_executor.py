@@ -0,0 +1,429 @@
+from __future__ import print_function, division, absolute_import
+
+import select
+import threading
+import time
+from collections import defaultdict, deque
+try:
+    from concurrent.futures import Future
+except ImportError:
+    raise ImportError(
+        'concurrent.futures not found: for Python 2 install the futures '
+        'backport (pip install futures)')
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as N
+
+from .xspec_proc import XspecProcDied
+
+class Job:
+    """Evaluation of a parameter set, which is made up of the
+    statistic computed by each ProcState."""
+
+    def __init__(self, vals, like, npending, future):
+        self.vals = vals
+        self.like = like
+        self.npending = npending
+        self.future = future
+
+    def add_result(self, like):
+        """Add likelihood from a ProcState, completing the job if all
+        the parts are done."""
+        self.like += like
+        self.npending -= 1
+        if self.npending == 0:
+            self.future.set_result(self.like)
+
+class HostHealth:
+    """Keep track of failures of xspec processes on each host,
+    quarantining hosts which fail repeatedly."""
+
+    def __init__(self, maxfailures=3, quarantinetime=1800., prefix=''):
+        self.maxfailures = maxfailures
+        self.quarantinetime = quarantinetime
+        self.prefix = prefix
+        # failures since last successful job
+        self.failures = defaultdict(int)
+        # time hosts were quarantined
+        self.quarantined = {}
+
+    def failed(self, host):
+        """Record a failure on host."""
+        self.failures[host] += 1
+        if (self.failures[host] >= self.maxfailures and
+                host not in self.quarantined):
+            print('%sQuarantining host %s after %i failures' % (
+                    self.prefix, host, self.failures[host]))
+            self.quarantined[host] = time.time()
+
+    def succeeded(self, host):
+        """Record a successful job on host."""
+        self.failures[host] = 0
+
+    def usable(self, host):
+        """Can we start processes on host?"""
+        start = self.quarantined.get(host)
+        if start is None:
+            return True
+        if time.time() - start > self.quarantinetime:
+            # try again, but quarantine again on the next failure
+            print('%sRetrying quarantined host %s' % (self.prefix, host))
+            del self.quarantined[host]
+            self.failures[host] = self.maxfailures-1
+            return True
+        return False
+
+class ProcState:
+    """This object is for handling the processing state for a group
+    of xspec processes of an XspecModel, which compute the statistic
+    for the same spectra.
+
+    Up to chunksize jobs are sent to a process at once, to reduce
+    the overhead of each round trip.
+
+    Processes which exit, close their output or exceed the job
+    timeout are killed and restarted, with their jobs moved back to
+    the queue. Messages are started with prefix.
+    """
+
+    def __init__(self, combmodel, xmodel, procs, health, chunksize=1,
+                 prefix=''):
+        self.xmodel = xmodel
+        self.health = health
+        self.chunksize = chunksize
+        self.prefix = prefix
+
+        # index in combined parameter vector of each model parameter
+        self.paridxs = [
+            combmodel.thawedparams.index(p) for p in xmodel.thawedparams]
+
+        # map fileno to xspec process
+        self.fileno_to_proc = {
+            x.fileno(): x for x in procs if x.popen is not None}
+
+        # fileno which are free to process
+        self.free = list(self.fileno_to_proc.keys())
+
+        # filenos which are doing work, mapping to list of Job
+        self.processing = {}
+        # time each chunk of jobs was sent
+        self.jobstart = {}
+
+        # filenos of restarted processes which are loading the XCM,
+        # mapping to the time they were restarted
+        self.starting = {}
+        # failed processes waiting to be restarted
+        self.dead = [x for x in procs if x.popen is None]
+
+        # jobs waiting to be sent
+        self.queue = deque()
+
+    def _newpar_args(self, vals):
+        """Build up arguments to newpar commands to send to xspec."""
+        modparams = defaultdict(list)
+        for param, idx in zip(self.xmodel.thawedparams, self.paridxs):
+            mpm = modparams[param.model]
+            while len(mpm) < param.index-1:
+                mpm.append('')
+            mpm.append('%e' % vals[idx])
+        # newpar arguments for each model
+        args = []
+        for model, pars in modparams.items():
+            args.append('%s1-%i & %s' % (
+                '' if model == 'unnamed' else model+':',
+                len(pars), ' & '.join(pars)))
+        return args
+
+    def job_cmd(self, valslist):
+        """Command to send to xspec to get the statistic for each
+        of the list of parameter sets."""
+        if len(valslist) == 1:
+            cmds = ['newpar '+a for a in self._newpar_args(valslist[0])]
+            # command to get output statistic
+            cmds.append('emcee_tcloutr stat')
+            return '\n'.join(cmds)
+        else:
+            # batch of parameters, returning list of statistics
+            # (called directly, so it also works without emcee_loop)
+            return 'emcee_batch {%s}' % ' '.join(
+                '{%s}' % ' '.join('{%s}' % a for a in self._newpar_args(v))
+                for v in valslist)
+
+    def send_jobs(self):
+        """Send queued jobs to any free processes."""
+        while self.free and self.queue:
+            # share out jobs between free processes
+            nchunk = -(-len(self.queue) // len(self.free))
+            nchunk = max(1, min(self.chunksize, nchunk))
+            jobs = [self.queue.popleft() for i in range(nchunk)]
+
+            fileno = self.free.pop()
+            proc = self.fileno_to_proc[fileno]
+            try:
+                proc.send_cmd(self.job_cmd([job.vals for job in jobs]))
+            except XspecProcDied as e:
+                self.queue.extendleft(reversed(jobs))
+                self._fail(fileno, str(e))
+                continue
+            self.processing[fileno] = jobs
+            self.jobstart[fileno] = time.time()
+
+    def busy_filenos(self):
+        """Filenos of processes we are waiting for."""
+        return list(self.processing.keys()) + list(self.starting)
+
+    def read_result(self, fileno):
+        """Read output from process, completing its job if there is a
+        result."""
+        proc = self.fileno_to_proc[fileno]
+        try:
+            result = proc.read_buffer()
+        except XspecProcDied as e:
+            self._fail(fileno, str(e))
+            return
+        if result is None:
+            return
+
+        # free up process for next job
+        self.free.append(fileno)
+
+        if fileno in self.starting:
+            # restarted process is ready
+            del self.starting[fileno]
+            print('%sRestarted xspec on %s' % (self.prefix, proc.system))
+            return
+
+        jobs = self.processing.pop(fileno)
+        del self.jobstart[fileno]
+        self.health.succeeded(proc.system)
+
+        # valid result, so get likelihood
+        for job, stat in zip(jobs, result.split()):
+            job.add_result(-0.5*float(stat))
+
+    def _fail(self, fileno, reason):
+        """Kill failed process, moving its jobs back to the queue."""
+        print('%sXspec process failed: %s' % (self.prefix, reason))
+        proc = self.fileno_to_proc.pop(fileno)
+        jobs = self.processing.pop(fileno, [])
+        # let a healthy process do these next
+        self.queue.extendleft(reversed(jobs))
+        self.jobstart.pop(fileno, None)
+        self.starting.pop(fileno, None)
+        if fileno in self.free:
+            self.free.remove(fileno)
+
+        proc.kill()
+        self.health.failed(proc.system)
+        self.dead.append(proc)
+
+    def check_timeouts(self, jobtimeout, starttimeout):
+        """Fail processes which have taken too long for a job (the
+        jobtimeout is per job in the chunk sent), or restarted
+        processes taking longer than starttimeout to load the XCM.
+        Timeouts which are not set are not checked."""
+        now = time.time()
+        if jobtimeout:
+            for fileno, start in list(self.jobstart.items()):
+                if now - start > jobtimeout*len(self.processing[fileno]):
+                    self._fail(fileno, 'job timed out on %s' % (
+                            self.fileno_to_proc[fileno].system))
+        if starttimeout:
+            for fileno, start in list(self.starting.items()):
+                if now - start > starttimeout:
+                    self._fail(fileno, 'restart timed out on %s' % (
+                            self.fileno_to_proc[fileno].system))
+
+    def respawn_dead(self):
+        """Restart failed processes on hosts which are not
+        quarantined. The restarted processes load the XCM in the
+        background."""
+        for proc in list(self.dead):
+            if not self.health.usable(proc.system):
+                continue
+            self.dead.remove(proc)
+            print('%sRestarting xspec on %s' % (self.prefix, proc.system))
+            try:
+                proc.respawn()
+            except (OSError, XspecProcDied) as e:
+                print('%sCould not restart xspec on %s: %s' % (
+                        self.prefix, proc.system, e))
+                proc.kill()
+                self.health.failed(proc.system)
+                self.dead.append(proc)
+                continue
+            fileno = proc.fileno()
+            self.fileno_to_proc[fileno] = proc
+            self.starting[fileno] = time.time()
+
+    def pending_jobs(self):
+        """Return jobs which are queued or being processed."""
+        return list(self.queue) + sum(self.processing.values(), [])
+
+class XspecExecutor:
+    """Asynchronous executor which computes log posterior values for
+    parameter sets using the xspec processes of a CombinedModel.
+
+    Jobs are scheduled on the processes by a background thread, and
+    are returned as concurrent.futures Future objects as soon as they
+    are complete (not necessarily in the order submitted). Each job
+    is evaluated by every group of processes of every XspecModel, and
+    the statistics are summed.
+
+    Failed processes are restarted and their jobs are given to other
+    processes. A process fails if it exits, or if it takes longer
+    than jobtimeout seconds for a job, or starttimeout seconds to
+    restart (if set). Hosts with maxfailures failures in a row are
+    not used for quarantinetime seconds.
+
+    Up to chunksize evaluations are sent to a process at once.
+
+    Messages are started with prefix (e.g. to identify the job when
+    several are running at once).
+    """
+
+    def __init__(self, combmodel, jobtimeout=None, starttimeout=600.,
+                 maxfailures=3, quarantinetime=1800., chunksize=1,
+                 prefix=''):
+        self.combmodel = combmodel
+        self.jobtimeout = jobtimeout
+        self.starttimeout = starttimeout
+        self.health = HostHealth(
+            maxfailures=maxfailures, quarantinetime=quarantinetime,
+            prefix=prefix)
+
+        # each group of processes of each xspecmodel has a processing
+        # state (the groups compute the statistic for different
+        # spectra, which are summed)
+        self.states = [
+            ProcState(combmodel, xmodel, procs, self.health,
+                      chunksize=chunksize, prefix=prefix)
+            for xmodel in combmodel.xspecmodels
+            for procs in xmodel.procgroups
+            ]
+
+        self._submitted = queue.Queue()
+        self._stop = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, vals, withprior=True):
+        """Submit a parameter set (physical values of the thawed
+        parameters of the CombinedModel) for evaluation.
+
+        Returns a Future giving the log posterior (or the log
+        likelihood if withprior is False). Parameter sets outside the
+        prior are not evaluated and give the prior (-inf).
+        """
+
+        if self._error is not None:
+            raise RuntimeError('Executor has failed: %s' % self._error)
+
+        future = Future()
+        vals = N.array(vals, dtype=N.float64)
+        prior = self.combmodel.prior(vals)
+        if not N.isfinite(prior):
+            future.set_result(prior)
+        else:
+            job = Job(vals, prior if withprior else 0.,
+                      len(self.states), future)
+            self._submitted.put(job)
+            if self._error is not None and not future.done():
+                # scheduling thread failed while we were submitting
+                future.set_exception(self._error)
+        return future
+
+    def submit_batch(self, valslist, withprior=True):
+        """Submit a list of parameter sets, returning a list of Futures."""
+        return [self.submit(v, withprior=withprior) for v in valslist]
+
+    def map(self, valslist, withprior=True):
+        """Evaluate a list of parameter sets, returning an array of log
+        posterior values (or log likelihoods if withprior is False).
+
+        This is suitable as a batch log likelihood function for other
+        samplers."""
+        futures = self.submit_batch(valslist, withprior=withprior)
+        return N.array([f.result() for f in futures])
+
+    def submit_async(self, vals, withprior=True):
+        """Submit a parameter set from an asyncio event loop, returning
+        an awaitable asyncio Future (Python 3 only)."""
+        import asyncio
+        return asyncio.wrap_future(self.submit(vals, withprior=withprior))
+
+    def map_async(self, valslist, withprior=True):
+        """Submit a list of parameter sets from an asyncio event loop,
+        returning an awaitable giving the list of results (Python 3
+        only)."""
+        import asyncio
+        return asyncio.gather(*[
+                self.submit_async(v, withprior=withprior) for v in valslist])
+
+    def shutdown(self):
+        """Stop scheduling jobs (does not finish xspec processes)."""
+        self._stop = True
+        self._thread.join()
+
+    def _queue_job(self, job):
+        """Queue job on every processing state."""
+        for state in self.states:
+            state.queue.append(job)
+
+    def _loop_iter(self):
+        """Does a cycle of starting new jobs and getting the results
+        of old ones."""
+
+        # get newly submitted jobs
+        try:
+            while True:
+                self._queue_job(self._submitted.get_nowait())
+        except queue.Empty:
+            pass
+
+        for state in self.states:
+            state.check_timeouts(self.jobtimeout, self.starttimeout)
+            state.respawn_dead()
+            state.send_jobs()
+
+        busy = {}
+        for state in self.states:
+            for fileno in state.busy_filenos():
+                busy[fileno] = state
+
+        if busy:
+            # check for completed processes
+            for fileno in select.select(list(busy), [], [], 0.01)[0]:
+                busy[fileno].read_result(fileno)
+        else:
+            # wait for something to do
+            try:
+                self._queue_job(self._submitted.get(timeout=0.1))
+            except queue.Empty:
+                pass
+
+    def _run(self):
+        """Scheduling loop run in background thread."""
+        try:
+            while not self._stop:
+                self._loop_iter()
+        except Exception as e:
+            # pass on error to anyone waiting
+            self._error = e
+            jobs = set()
+            for state in self.states:
+                jobs.update(state.pending_jobs())
+            try:
+                while True:
+                    jobs.add(self._submitted.get_nowait())
+            except queue.Empty:
+                pass
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
@@ -1,6 +1,7 @@
 from __future__ import print_function, division, absolute_import
 
 import re
+import time
 import numpy as N
 
 from .xspec_proc import XspecProc
@@ -30,7 +31,8 @@ class Par:
 class XspecModel:
     """Handle multiple Xspec processes and model."""
 
-    def __init__(self, xcm, systems, debug=False, nochdir=False, xspecindex=-1, nofit=False):
+    def __init__(self, xcm, systems, debug=False, nochdir=False, xspecindex=-1, nofit=False,
+                 nsplit=1, splitby='spectrum'):
 
         self.nofit = nofit
         self.xspecindex = xspecindex
@@ -47,6 +49,12 @@ class XspecModel:
             thawed = [p for p in self.pars[modelname] if p.thawed]
             self.thawedparams += thawed
 
+        # groups of processes, each computing the statistic for a
+        # subset of the spectra (by default every process does all)
+        self.procgroups = [self.procs]
+        if nsplit > 1:
+            self._split_spectra(xcm, systems[0], debug, nochdir, nsplit, splitby)
+
     def xspec_thawed_idxs(self):
         """Return list of thawed parameter indices in xspec format."""
         return [
@@ -54,13 +62,116 @@ class XspecModel:
             for p in self.thawedparams
             ]
 
+    def _spectrum_units(self, splitby):
+        """Get list of lists of spectra which can be split between
+        processes (single spectra or data groups)."""
+
+        p0 = self.procs[0]
+        nspec = int(p0.tclout('datasets'))
+        if splitby == 'spectrum':
+            return [[i] for i in range(1, nspec+1)]
+        elif splitby == 'group':
+            groups = {}
+            for i in range(1, nspec+1):
+                grp = int(p0.tclout('datagrp %i' % i))
+                groups.setdefault(grp, []).append(i)
+            return [groups[g] for g in sorted(groups)]
+        else:
+            raise RuntimeError('Invalid split type %s' % repr(splitby))
+
+    def _measure_unit_costs(self, xcm, system, debug, nochdir, units, nrepeat=3):
+        """Measure time to compute the statistic for each unit of spectra.
+
+        This uses a temporary xspec process, ignoring the units one at
+        a time and measuring the change in evaluation time. The
+        fixed cost of an evaluation with every unit ignored is not
+        included.
+        """
+
+        proc = XspecProc(xcm, system, debug=debug, nochdir=nochdir)
+        proc.wait()
+
+        # change a thawed parameter to force the model to be recomputed
+        par = self.thawedparams[0]
+        mprefix = '' if par.model=='unnamed' else par.model+':'
+        vals = [par.initval, par.initval+par.delta*1e-3]
+        # alternate across all calls, starting with the value which
+        # the process does not already have
+        counter = [1]
+
+        def timestat():
+            best = None
+            for i in range(nrepeat):
+                start = time.time()
+                proc.single_cmd('newpar %s%i %e\nemcee_tcloutr stat' % (
+                        mprefix, par.index, vals[counter[0]%2]))
+                delta = time.time() - start
+                counter[0] += 1
+                best = delta if best is None else min(best, delta)
+            return best
+
+        costs = [0.]*len(units)
+        last = timestat()
+        for i in range(len(units)-1, -1, -1):
+            for spec in units[i]:
+                proc.send_cmd('ignore %i:1-**' % spec)
+            # the last time, with every unit ignored, is the baseline
+            now = timestat()
+            costs[i] = max(last - now, 1e-6)
+            last = now
+
+        proc.send_finish()
+        proc.wait_finish()
+        return costs
+
+    def _split_spectra(self, xcm, system, debug, nochdir, nsplit, splitby):
+        """Split the spectra between nsplit groups of processes,
+        balancing the measured cost of each group."""
+
+        units = self._spectrum_units(splitby)
+        nsplit = min(nsplit, len(units))
+        if nsplit <= 1:
+            return
+        if len(self.procs) % nsplit != 0:
+            raise RuntimeError(
+                'Number of processes (%i) must be a multiple of the number '
+                'of parts to split into (%i)' % (len(self.procs), nsplit))
+
+        print('Measuring cost of spectra...')
+        costs = self._measure_unit_costs(xcm, system, debug, nochdir, units)
+
+        # greedily assign most expensive units to least loaded part
+        parts = [[] for i in range(nsplit)]
+        partcosts = [0.]*nsplit
+        for ui in sorted(range(len(units)), key=lambda i: -costs[i]):
+            pi = partcosts.index(min(partcosts))
+            parts[pi] += units[ui]
+            partcosts[pi] += costs[ui]
+
+        allspec = sorted(sum(units, []))
+        self.procgroups = [[] for i in range(nsplit)]
+        for i, proc in enumerate(self.procs):
+            pi = i % nsplit
+            self.procgroups[pi].append(proc)
+            for spec in allspec:
+                if spec not in parts[pi]:
+                    proc.send_setup_cmd('ignore %i:1-**' % spec)
+            proc.wait()
+
+        print('Split spectra between %i parts:' % nsplit)
+        for pi in range(nsplit):
+            print('  Part %i: spectra %s, %i process(es), cost %.3gs' % (
+                    pi+1, ','.join(str(x) for x in sorted(parts[pi])),
+                    len(self.procgroups[pi]), partcosts[pi]))
+
     def finish(self):
         """Finish all processes."""
         for proc in self.procs:
-            self.send_finish()
+            proc.send_finish()
         for proc in self.procs:
-            self.wait_finish()
+            proc.wait_finish()
         del self.procs[:]
+        self.procgroups = []
 
     def _get_pars(self):
         """Get parameters from xcm file
@@ -1,7 +1,6 @@
 from __future__ import print_function, division, absolute_import
 
-import select
-from collections import defaultdict
+import re
 
 import numpy as N
 
@@ -22,6 +21,11 @@ class CombinedModel:
                     self.thawedparams.append(tp)
                     existing.add(tp)
 
+    def finish(self):
+        """Finish all xspec processes."""
+        for model in self.xspecmodels:
+            model.finish()
+
     def log_norms_priors(self, minnorm=1e-10):
         """Modify priors on norms to be flat in log space."""
 
@@ -50,6 +54,42 @@ class CombinedModel:
         for par, val in zip(self.thawedparams, vals):
             par.currentval = val
 
+    def find_thawed(self, spec):
+        """Find parameter using [xcmindex:][[modelname]:]paramindex.
+
+        Returns (xcmindex, index into thawed parameters of that model)
+        """
+        p = spec.split(':')
+        if len(p) > 3:
+            raise RuntimeError('Parameter expression should have at most 3 parts')
+        elif len(p) == 2:
+            p = [1] + p
+        elif len(p) == 1:
+            p = [1, 'unnamed'] + p
+        xcmindex = int(p[0])
+        modname = p[1].strip() if p[1].strip() else 'unnamed'
+        paramindex = int(p[2])
+
+        params = self.xspecmodels[xcmindex-1].thawedparams
+        for i, par in enumerate(params):
+            if par.model == modname and par.index == paramindex:
+                return xcmindex, i
+        raise RuntimeError('Cannot find parameter', modname, paramindex)
+
+    def select_params(self, spec):
+        """Return indices into thawedparams matching a parameter
+        expression (see find_thawed) or a parameter name (e.g. norm)."""
+        if re.match(r'^\s*([0-9]+:)?([0-9A-Za-z_ ]*:)?[0-9]+\s*$', spec):
+            xcmindex, idx = self.find_thawed(spec)
+            par = self.xspecmodels[xcmindex-1].thawedparams[idx]
+            return [self.thawedparams.index(par)]
+
+        out = [i for i, par in enumerate(self.thawedparams)
+               if par.name == spec.strip()]
+        if not out:
+            raise RuntimeError('No thawed parameters named %s' % repr(spec))
+        return out
+
     def link_parameters(self, linkexpr):
         """Link two parameters.
 
@@ -59,136 +99,45 @@ class CombinedModel:
         Default xcmindex is 1 and default modelname is unnamed
         """
 
-        def defpart(t):
-            p = t.split(':')
-            if len(p) > 3:
-                raise RuntimeError('Parameter expression should have at most 3 parts')
-            elif len(p) == 2:
-                p = [1] + p
-            elif len(p) == 1:
-                p = [1, 'unnamed'] + p
-            p[0] = int(p[0])
-            p[1] = p[1].strip() if p[1].strip() else 'unnamed'
-            p[2] = int(p[2])
-            return p
-
-        def findindex(params, modname, paramindex):
-            for i, p in enumerate(params):
-                if p.model == modname and p.index == paramindex:
-                    return i
-            raise RuntimeError('Cannot find parameter', modname, paramindex)
-
-        left, right = linkexpr.split('=')
-        left, right = defpart(left), defpart(right)
-
-        print(" Linked parameter %i:%s:%i to %i:%s:%i" % tuple(right+left))
+        leftexpr, rightexpr = linkexpr.split('=')
+        lxcm, lidx = self.find_thawed(leftexpr)
+        rxcm, ridx = self.find_thawed(rightexpr)
 
         # get xspec models
-        lxmodel = self.xspecmodels[left[0]-1]
-        rxmodel = self.xspecmodels[right[0]-1]
+        lxmodel = self.xspecmodels[lxcm-1]
+        rxmodel = self.xspecmodels[rxcm-1]
 
-        # get parameter indices
+        # get parameters
         lthaw, rthaw = lxmodel.thawedparams, rxmodel.thawedparams
-        lidx = findindex(lthaw, left[1], left[2])
-        ridx = findindex(rthaw, right[1], right[2])
-        lp, rp = lthaw[lidx], rthaw[lidx]
+        lp, rp = lthaw[lidx], rthaw[ridx]
+        print(" Linked parameter %i:%s:%i to %i:%s:%i" % (
+                rxcm, rp.model, rp.index, lxcm, lp.model, lp.index))
         print("  (%s:%s:%s:%s -> %s:%s:%s:%s)" % (
-                right[0], rp.model, rp.cmpt, rp.name,
-                left[0], lp.model, lp.cmpt, lp.name))
+                rxcm, rp.model, rp.cmpt, rp.name,
+                lxcm, lp.model, lp.cmpt, lp.name))
 
         # assign right parameter to left model
         lthaw[lidx] = rthaw[ridx]
 
         self.update_thawed()
 
-class ProcState:
-    """This object is for handling the processing state for a set of
-    XspecModel objects."""
+class XspecPool:
+    def __init__(self, combmodel, executor, transform=None, prefix=''):
+        """Fake pool object to return likelihoods for parameter sets.
 
-    def __init__(self, combmodel, xmodel, paramlist, likes, toprocess):
-        self.combmodel = combmodel
-        self.xmodel = xmodel
-        self.paramlist = paramlist
-        self.likes = likes
-        self.toprocess = list(toprocess)
-
-        # map fileno to xspec process
-        self.fileno_to_proc = {x.fileno(): x for x in xmodel.procs}
-
-        # fileno which are free to process
-        self.free = list(self.fileno_to_proc.keys())
-
-        # filenos which are doing work
-        self.processing = {}
-
-    def _check(self):
-        """Check whether processes have returned results and get them."""
-
-        # iterate over processes which have written to stdout
-        for fileno in select.select(
-            list(self.processing.keys()), [], [], 0.01)[0]:
-
-            proc = self.fileno_to_proc[fileno]
-            result = proc.read_buffer()
-            if result is not None:
-                # valid result, so get likelihood
-                like = -0.5*float(result)
-                self.likes[self.processing[fileno]] += like
-
-                # free up process for next job
-                self.free.append(fileno)
-                del self.processing[fileno]
-
-    def _send_job(self):
-        """Send the next job to process."""
-        paridx = self.toprocess.pop()
-        paramset = self.paramlist[paridx]
-
-        self.combmodel.update_param_vals(paramset)
-
-        # build up newpar command to send to xspec
-        modparams = defaultdict(list)
-        for param in self.xmodel.thawedparams:
-            mpm = modparams[param.model]
-            while len(mpm) < param.index-1:
-                mpm.append('')
-            mpm.append('%e' % param.currentval)
-        # newpar command for each model
-        cmds = []
-        for model, pars in modparams.items():
-            cmd = 'newpar %s1-%i & %s' % (
-                '' if model == 'unnamed' else model+':',
-                len(pars), ' & '.join(pars))
-            cmds.append(cmd)
-        # command to get output statistic
-        cmds.append('emcee_tcloutr stat')
-
-        fileno = self.free.pop()
-        proc = self.fileno_to_proc[fileno]
-        proc.send_cmd('\n'.join(cmds))
-        self.processing[fileno] = paridx
-
-    def loop_iter(self):
-        """Does a cycle of starting new jobs and getting the results
-        of old ones.
-
-        Returns True if eveything done."""
-
-        if self.free and self.toprocess:
-            # send next job
-            self._send_job()
-
-        elif self.processing:
-            # check for a completed process
-            self._check()
-
-        return not self.toprocess and not self.processing
+        The evaluations are done using executor (an XspecExecutor),
+        which the caller should shut down when finished.
 
-class XspecPool:
-    def __init__(self, combmodel):
-        """Fake pool object to return likelihoods for parameter sets."""
+        If transform (a ParamTransform) is given, the parameter sets
+        are in the sampling space of the transform.
+
+        Progress lines are started with prefix.
+        """
 
         self.combmodel = combmodel
+        self.transform = transform
+        self.prefix = prefix
+        self.executor = executor
 
         # keep track of evaluations
         self.itercount = 0
@@ -203,32 +152,19 @@ class XspecPool:
         # convert generator->list
         paramlist = list(paramlist)
 
-        # get prior for initial likelihood
-        likes = N.array([self.combmodel.prior(v) for v in paramlist])
-        # list of parameters with finite priors
-        toprocess = list(N.nonzero(N.isfinite(likes))[0])
-
-        #notfinite = ~N.isfinite(likes)
-        #for i in N.nonzero(notfinite)[0]:
-        #    print(paramlist[i])
-
-        # each xspecmodel has a processing state for each of the parameters
-        states = [
-            ProcState(self.combmodel, xmodel, paramlist, likes, toprocess)
-            for xmodel in self.combmodel.xspecmodels
-            ]
-
-        while True:
-            alldone = True
-            for state in states:
-                done = state.loop_iter()
-                alldone = alldone and done
-            if alldone:
-                break
+        if self.transform is None:
+            likes = self.executor.map(paramlist)
+        else:
+            # convert to physical parameters, including Jacobian in prior
+            tr = self.transform
+            physlist = [tr.to_physical(u) for u in paramlist]
+            likes = self.executor.map(physlist) + N.array(
+                [tr.log_jacobian(u) for u in paramlist])
 
         likefilt = likes[N.isfinite(likes)]
         if len(likefilt) > 0 and self.itercount % 2 == 0:
-            print('%5i   mean=<%9.1f> max=<%9.1f> std=<%9.1f> good=<%4i/%4i>' % (
+            print('%s%5i   mean=<%9.1f> max=<%9.1f> std=<%9.1f> good=<%4i/%4i>' % (
+                    self.prefix,
                     self.itercount // 2,
                     likefilt.mean(),
                     likefilt.max(),
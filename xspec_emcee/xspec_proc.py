@@ -5,6 +5,7 @@ import os.path
 import os
 import re
 import subprocess
+import sys
 
 # script to start xspec
 thisdir = os.path.dirname( os.path.abspath(__file__) )
@@ -20,15 +21,29 @@ running_procs = set()
 @atexit.register
 def _finish_running_procs():
     """End any xspec processes in event of crash."""
-    for p in running_procs:
-        p.send_finish()
+    for p in list(running_procs):
+        try:
+            p.send_finish()
+        except (XspecProcDied, IOError, OSError):
+            pass
     for p in list(running_procs):
         p.wait_finish()
 
+class XspecProcDied(RuntimeError):
+    """Xspec process has exited or closed its output."""
+    pass
+
 class XspecProc:
     """Handle Xspec process."""
 
     def __init__(self, xcm, system, debug=False, nochdir=False):
+        self.xcm = xcm
+        self.system = system
+        self.debug = debug
+        self.nochdir = nochdir
+        # commands to repeat if the process is restarted
+        self.setupcmds = []
+
         self.popen = self._init_subprocess(xcm, system, debug, nochdir)
         self.buffer = ''
         running_procs.add(self)
@@ -40,10 +55,17 @@ class XspecProc:
     def _init_subprocess(self, xcm, system, debug, nochdir):
         """Initialise the xspec process given."""
 
+        # run in a new session, so that Ctrl+C does not kill xspec
+        # (or ssh) and the processes can be finished normally
+        if sys.version_info >= (3, 2):
+            session = {'start_new_session': True}
+        else:
+            session = {'preexec_fn': os.setsid}
+
         cmd = [start_xspec, system]
         popen = subprocess.Popen(
             cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            universal_newlines=True, bufsize=1,
+            universal_newlines=True, bufsize=1, **session
         )
 
         # load helper routines
@@ -73,15 +95,30 @@ class XspecProc:
 
     def send_cmd(self, cmd):
         """Send a command."""
-        self.popen.stdin.write(cmd + '\n')
-        self.popen.stdin.flush()
+        if self.popen is None:
+            raise XspecProcDied('xspec on %s is not running' % self.system)
+        try:
+            self.popen.stdin.write(cmd + '\n')
+            self.popen.stdin.flush()
+        except (IOError, OSError, ValueError):
+            raise XspecProcDied('Cannot write to xspec on %s' % self.system)
+
+    def send_setup_cmd(self, cmd):
+        """Send a command which is repeated if the process is restarted."""
+        self.setupcmds.append(cmd)
+        self.send_cmd(cmd)
 
     def read_buffer(self):
         """Read from process into buffer.
 
         If there is a result in the buffer, then return string value
         """
-        self.buffer += os.read(self.popen.stdout.fileno(), 8192).decode('utf8')
+        data = os.read(self.popen.stdout.fileno(), 8192)
+        if not data:
+            raise XspecProcDied(
+                'xspec on %s exited (status %s)' % (
+                    self.system, self.popen.poll()))
+        self.buffer += data.decode('utf8')
         match = result_re.search(self.buffer)
         if match:
             result = match.group(1)
@@ -108,12 +145,49 @@ class XspecProc:
         self.single_cmd('emcee_wait')
 
     def send_finish(self):
-        """Tell subprocess to finish."""
-        self.send_cmd('quit')
-        self.popen.stdin.close()
+        """Tell subprocess to finish (does nothing if it was killed)."""
+        if self.popen is None:
+            return
+        try:
+            self.send_cmd('quit')
+            self.popen.stdin.close()
+        except (XspecProcDied, IOError, OSError):
+            # process has already exited
+            pass
+
+    def kill(self):
+        """Kill a failed subprocess."""
+        if self.popen is not None:
+            try:
+                self.popen.kill()
+            except OSError:
+                pass
+            self.popen.wait()
+            for f in self.popen.stdin, self.popen.stdout:
+                try:
+                    f.close()
+                except (IOError, OSError):
+                    pass
+            self.popen = None
+        running_procs.discard(self)
+
+    def respawn(self):
+        """Start a new subprocess to replace a failed one.
+
+        This does not wait for the XCM to load. The process writes an
+        empty result when it is ready.
+        """
+        self.buffer = ''
+        self.popen = self._init_subprocess(
+            self.xcm, self.system, self.debug, self.nochdir)
+        running_procs.add(self)
+        for cmd in self.setupcmds:
+            self.send_cmd(cmd)
+        self.send_cmd('emcee_wait')
 
     def wait_finish(self):
-        """Wait for subprocess to finish."""
-        self.popen.wait()
-        self.popen = None
-        running_procs.remove(self)
+        """Wait for subprocess to finish (does nothing if it was killed)."""
+        if self.popen is not None:
+            self.popen.wait()
+            self.popen = None
+        running_procs.discard(self)